@@ -1,153 +1,403 @@
 import streamlit as st
 import pandas as pd
-import plotly.express as px
+import plotly.graph_objects as go
 import datetime
-import uuid
+import secrets
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
 import gspread
+from google.oauth2.service_account import Credentials
+from google.auth.transport.requests import AuthorizedSession
+from requests.adapters import HTTPAdapter
+from urllib3.util import Retry
 
 # --- 1. CONFIGURAZIONE PAGINA ---
 st.set_page_config(page_title="Gestore Finanze Cloud", layout="wide", page_icon="☁️")
 
-# --- 2. CONNESSIONE DIRETTA DA FILE (Metodo Infallibile Locale) ---
-def connetti_google_sheet():
+COLONNE = ["ID", "Data", "Tipo", "Categoria", "Importo", "Note"]
+NOME_FOGLIO = "GestioneSpese"
+FILE_CREDENZIALI = "credentials.json"
+CAT_USCITA = ("Cibo", "Casa", "Trasporti", "Salute", "Svago", "Shopping", "Bollette", "Altro")
+CAT_ENTRATA = ("Stipendio", "Bonus", "Vendite", "Rimborsi", "Investimenti", "Altro")
+TIPI = ("Uscita", "Entrata")
+COLORI_TIPO = (("Entrata", "#00CC96"), ("Uscita", "#EF553B"))
+TIPO_DTYPE = pd.CategoricalDtype(["Entrata", "Uscita"])
+
+# --- 2. CONNESSIONE (secrets online, credentials.json in locale) ---
+def _credenziali_da_secrets():
+    # Senza secrets.toml Streamlit solleva un FileNotFoundError: in locale è normale
     try:
-        # Cerchiamo il file credentials.json nella cartella
-        # Se siamo in locale userà questo, se siamo online userà i secrets (opzionale, ma ora concentriamoci sul PC)
-        filename = "credentials.json"
-        
-        # Questa funzione di gspread legge direttamente il file JSON fisico
+        return st.secrets.get("gcp_service_account")
+    except FileNotFoundError:
+        return None
+
+# Client e foglio restano in cache per tutto il processo: niente nuovo handshake OAuth a ogni rerun
+@st.cache_resource(show_spinner=False)
+def _get_client():
+    credenziali = _credenziali_da_secrets()
+    if credenziali:
+        creds = Credentials.from_service_account_info(dict(credenziali), scopes=gspread.auth.DEFAULT_SCOPES)
+    else:
+        # Altrimenti cerchiamo il file credentials.json nella cartella
+        # Leggiamo direttamente il file JSON fisico
         # Bypassa qualsiasi errore di conversione di Streamlit
-        client = gspread.service_account(filename=filename)
-        
-        sheet = client.open("GestioneSpese").sheet1 
-        return sheet
-        
+        creds = Credentials.from_service_account_file(FILE_CREDENZIALI, scopes=gspread.auth.DEFAULT_SCOPES)
+
+    # Sessione HTTP unica per il client: connessioni TLS riusate e retry con backoff sugli errori temporanei.
+    # Retry non ripete i POST (es. append_row), così un inserimento non viene mai duplicato;
+    # raise_on_status=False lascia l'ultima risposta a gspread, che la trasforma in APIError
+    sessione = AuthorizedSession(creds)
+    sessione.mount("https://", HTTPAdapter(
+        pool_connections=4,
+        pool_maxsize=8,
+        max_retries=Retry(total=5, backoff_factor=0.3, status_forcelist=[429, 500, 502, 503, 504], raise_on_status=False)
+    ))
+    return gspread.Client(auth=creds, session=sessione)
+
+@st.cache_resource(show_spinner=False)
+def _get_sheet():
+    return _get_client().open(NOME_FOGLIO).sheet1
+
+def connetti_google_sheet():
+    try:
+        return _get_sheet()
     except FileNotFoundError:
-        st.error("⚠️ File 'credentials.json' non trovato! Assicurati di averlo creato nella cartella Spese.")
+        st.error(f"⚠️ File '{FILE_CREDENZIALI}' non trovato! Assicurati di averlo creato nella cartella Spese.")
         st.stop()
     except Exception as e:
         st.error(f"⚠️ Errore critico connessione: {e}")
         st.stop()
 
+def su_foglio(operazione):
+    # Esegue operazione(sheet); se il token in cache è scaduto (401) ricrea client e foglio e riprova una volta
+    try:
+        return operazione(connetti_google_sheet())
+    except gspread.exceptions.APIError as e:
+        if e.response.status_code != 401:
+            raise
+        _get_sheet.clear()
+        _get_client.clear()
+        return operazione(connetti_google_sheet())
+
 def genera_id():
-    return str(uuid.uuid4())[:8]
+    # 8 caratteri esadecimali (32 bit casuali) generati direttamente
+    return secrets.token_hex(4)
+
+@st.cache_data(ttl=60, show_spinner=False)
+def _download_records(rev):
+    # rev serve solo come chiave di cache: viene incrementato a ogni scrittura
+    # Valori grezzi (lista di liste): niente dict per riga come con get_all_records
+    valori = su_foglio(lambda sheet: sheet.get_all_values())
+    if not valori:
+        su_foglio(lambda sheet: sheet.append_row(COLONNE))
+        return []
+    return valori
+
+def _mappa_righe(ids):
+    # {ID: numero di riga nel foglio}, la riga 1 è l'intestazione
+    return {id_: riga for riga, id_ in enumerate(ids[1:], start=2)}
+
+def invalida_dati():
+    # Il prossimo rerun di questa sessione riscarica dal foglio. Le altre sessioni
+    # tengono i loro dati in memoria finché non premono "🔄 Ricarica"
+    st.session_state["rev"] = st.session_state.get("rev", 0) + 1
+    st.session_state.pop("df", None)
+    _download_records.clear()
 
-def carica_dati():
-    cols = ["ID", "Data", "Tipo", "Categoria", "Importo", "Note"]
-    df = pd.DataFrame(columns=cols) 
+def carica_dati(obbligatorio=False):
+    df = pd.DataFrame(columns=COLONNE) 
     
     try:
-        sheet = connetti_google_sheet()
-        
-        if not sheet.get_all_values():
-            sheet.append_row(cols)
-            return df
-
-        data = sheet.get_all_records()
-        if data:
-            df = pd.DataFrame(data)
+        valori = _download_records(st.session_state.get("rev", 0))
+        if len(valori) > 1:
+            df = pd.DataFrame(valori[1:], columns=valori[0])
+            # Sempre float: con soli importi interi sarebbe int64 e i decimali verrebbero troncati
+            df["Importo"] = pd.to_numeric(df["Importo"], errors='coerce').astype("float64")
             
     except Exception as e:
+        # Al salvataggio un download fallito non può diventare un foglio vuoto
+        if obbligatorio:
+            raise
         st.warning(f"Avvio con database vuoto. ({e})")
 
     if "Data" in df.columns:
-        df["Data"] = pd.to_datetime(df["Data"], errors='coerce')
+        # Formato fisso: parser C veloce invece dell'inferenza riga per riga
+        date = pd.to_datetime(df["Data"], format='%Y-%m-%d', errors='coerce')
+        residuo = date.isna()
+        if residuo.any():
+            # Righe vecchie in altri formati: solo queste passano dal parser generico
+            date = date.fillna(pd.to_datetime(df.loc[residuo, "Data"], errors='coerce'))
+        df["Data"] = date
         df = df.dropna(subset=["Data"])
         
     return df
 
+def prepara_dati(df):
+    # Tipi e colonne derivate calcolati solo quando i dati della sessione cambiano, non a ogni rerun
+    df = df.copy()
+
+    # Colonne a bassa cardinalità come categorie: codici int8 invece di stringhe Python
+    # "entrata " scritto a mano vale "Entrata"; valori sconosciuti restano com'erano invece di diventare NaN
+    tipi = df["Tipo"].astype(object).str.strip().str.capitalize()
+    # Cella vuota = Tipo mancante, non un tipo sconosciuto
+    tipi = tipi.mask(tipi == "")
+    sconosciuti = [t for t in tipi.dropna().unique() if t not in TIPO_DTYPE.categories]
+    if sconosciuti:
+        st.warning(f"Tipo non riconosciuto: {', '.join(map(repr, sconosciuti))}")
+    df["Tipo"] = tipi.astype(pd.CategoricalDtype(list(TIPO_DTYPE.categories) + sconosciuti))
+    # Tutte le categorie note, non solo quelle già usate: il data_editor mostra le categorie come menu
+    categorie = dict.fromkeys(CAT_USCITA + CAT_ENTRATA)
+    categorie.update(dict.fromkeys(df["Categoria"].dropna().unique()))
+    df["Categoria"] = df["Categoria"].astype(pd.CategoricalDtype(list(categorie)))
+
+    # Indice temporale ordinato: il filtro per anno diventa uno slice con ricerca binaria
+    df.index = pd.DatetimeIndex(df["Data"].to_numpy())
+    df = df.sort_index()
+    # Anno calcolato una volta sola: la lista degli anni lavora su int16 invece che su datetime64
+    df["Anno"] = df["Data"].dt.year.astype("int16")
+    return df
+
+def aggiungi_riga(df, record):
+    # Una riga sola: si prepara solo lei e la si infila al suo posto nell'indice già ordinato,
+    # senza rifare categorie, ordinamento e Anno su tutto il DataFrame
+    riga = prepara_dati(pd.DataFrame([record]))
+    if df.empty:
+        return riga
+    # Stesse categorie del DataFrame, così concat non ricade su object;
+    # le altre colonne le lascia scegliere a concat (un 12.50 non va troncato a int)
+    riga = riga.astype({c: df[c].dtype for c in ("Tipo", "Categoria")})
+    pos = df.index.searchsorted(riga.index[0], side="right")
+    return pd.concat([df.iloc[:pos], riga, df.iloc[pos:]])
+
 def salva_dati_su_cloud(df):
     try:
-        sheet = connetti_google_sheet()
-        df_export = df.copy()
-        df_export["Data"] = df_export["Data"].dt.strftime('%Y-%m-%d')
-        dati_completi = [df_export.columns.values.tolist()] + df_export.values.tolist()
+        # Celle vuote come "": un NaN nel payload fa fallire la serializzazione JSON
+        dati_completi = [COLONNE] + _righe_export(df).values.tolist()
         
-        sheet.clear()
-        sheet.update(range_name='A1', values=dati_completi)
+        def riscrivi(sheet):
+            with _lock_scritture():
+                # Prima si scrive e poi si puliscono solo le righe in più:
+                # se l'update fallisce il foglio resta com'era invece che vuoto
+                vecchie = len(sheet.col_values(1))
+                sheet.update(range_name='A1', values=dati_completi)
+                if vecchie > len(dati_completi):
+                    sheet.batch_clear([f'A{len(dati_completi) + 1}:F{vecchie}'])
+        su_foglio(riscrivi)
+        invalida_dati()
         return True
     except Exception as e:
         st.error(f"Errore salvataggio Cloud: {e}")
         return False
 
+# --- SCRITTURE IN BACKGROUND ---
+# Un solo worker: le righe arrivano sul foglio nell'ordine di inserimento
+@st.cache_resource(show_spinner=False)
+def _pool():
+    return ThreadPoolExecutor(max_workers=1)
+
+# Condiviso tra sessioni e thread: mai due scritture insieme sullo stesso foglio
+@st.cache_resource(show_spinner=False)
+def _lock_scritture():
+    return threading.Lock()
+
+def append_record(sheet, row_values):
+    # Inserimento singolo: una sola chiamata values.append invece di riscrivere tutto il foglio
+    # Gira nel thread del pool, quindi niente chiamate st.* qui dentro
+    with _lock_scritture():
+        sheet.append_row(list(row_values), value_input_option='RAW')
+
+def controlla_salvataggi(attendi=False):
+    # Raccoglie l'esito degli inserimenti lanciati nei rerun precedenti
+    salvataggi = st.session_state.get("save_futures", [])
+    if attendi:
+        wait([futuro for _, futuro in salvataggi])
+
+    in_corso = []
+    for id_, futuro in salvataggi:
+        if not futuro.done():
+            in_corso.append((id_, futuro))
+            continue
+        try:
+            futuro.result()
+            st.toast("Salvato!")
+        except Exception as e:
+            if "df" in st.session_state:
+                st.session_state.df = st.session_state.df[st.session_state.df["ID"] != id_]
+            st.error(f"Errore salvataggio Cloud: {e}")
+    st.session_state["save_futures"] = in_corso
+
+def _righe_export(df):
+    df_export = df[COLONNE].copy()
+    df_export["Data"] = df_export["Data"].dt.strftime('%Y-%m-%d')
+    # object: valori Python nativi, serializzabili in JSON per l'API
+    return df_export.astype(object).fillna("")
+
+def salva_modifiche(df_prima, df_dopo):
+    # Invia al foglio solo le differenze tra la tabella mostrata e quella modificata
+    # Righe senza Data o Tipo: il foglio le accetterebbe ma al caricamento sparirebbero
+    incomplete = int((df_dopo["Data"].isna() | df_dopo["Tipo"].isna()).sum())
+    if incomplete:
+        st.warning(f"{incomplete} righe senza Data o Tipo: completale prima di salvare.")
+        return False
+    try:
+        vecchi = _righe_export(df_prima).set_index("ID")
+        nuovi = _righe_export(df_dopo).set_index("ID")
+
+        comuni = nuovi.index.intersection(vecchi.index)
+        cambiati = comuni[(nuovi.loc[comuni] != vecchi.loc[comuni]).any(axis=1)]
+        aggiunti = nuovi.loc[~nuovi.index.isin(vecchi.index)]
+        tolti = vecchi.index.difference(nuovi.index)
+
+        def applica(sheet):
+            with _lock_scritture():
+                # Unica lettura del salvataggio: la sola colonna degli ID, sempre fresca
+                # e fatta sotto il lock. Una mappa in cache, o letta prima del lock, può
+                # avere numeri di riga vecchi (modifiche a mano, eliminazioni di altre
+                # sessioni) e l'aggiornamento finirebbe sulla riga sbagliata
+                righe = _mappa_righe(sheet.col_values(1))
+                if not vecchi.index.isin(righe.keys()).all():
+                    return False
+                if len(cambiati):
+                    sheet.batch_update([
+                        {'range': f'A{righe[i]}:F{righe[i]}', 'values': [[i] + nuovi.loc[i].tolist()]}
+                        for i in cambiati
+                    ], value_input_option='RAW')
+                if not aggiunti.empty:
+                    sheet.append_rows(aggiunti.reset_index().values.tolist(), value_input_option='RAW')
+                if len(tolti):
+                    # Tutte le eliminazioni in una sola richiesta, dal basso verso l'alto
+                    # così i numeri di riga restanti non scorrono
+                    sheet.spreadsheet.batch_update({"requests": [
+                        {"deleteDimension": {"range": {
+                            "sheetId": sheet.id, "dimension": "ROWS",
+                            "startIndex": riga - 1, "endIndex": riga
+                        }}}
+                        for riga in sorted((righe[i] for i in tolti), reverse=True)
+                    ]})
+                return True
+
+        if not su_foglio(applica):
+            # Il foglio è cambiato dall'ultima lettura: si torna alla riscrittura completa
+            invalida_dati()
+            df_db = carica_dati(obbligatorio=True)
+            df_db = df_db.loc[~df_db["ID"].isin(set(df_prima["ID"]))]
+            df_finale = pd.concat([df_db, df_dopo], ignore_index=True)
+            if not salva_dati_su_cloud(df_finale):
+                return False
+            st.session_state.df = prepara_dati(df_finale)
+            return True
+
+        # Il foglio ora coincide con i dati in memoria più le modifiche: niente nuovo download
+        df_sessione = st.session_state.df
+        df_sessione = df_sessione.loc[~df_sessione["ID"].isin(set(df_prima["ID"]))]
+        invalida_dati()
+        st.session_state.df = prepara_dati(pd.concat([df_sessione, df_dopo], ignore_index=True))
+        return True
+    except Exception as e:
+        st.error(f"Errore salvataggio Cloud: {e}")
+        return False
+
+@st.cache_data(show_spinner=False, max_entries=16)
+def crea_grafico_trend(df):
+    # Figura in cache: ricostruita solo quando cambiano i dati mostrati.
+    # Ogni anno e ogni modifica è una voce nuova: si tengono solo le ultime
+    # Tracce go.Bar costruite a mano sugli array numpy, senza il passaggio pandas di plotly.express
+    barre = []
+    for tipo, colore in COLORI_TIPO:
+        righe = df[df["Tipo"] == tipo]
+        if not righe.empty:
+            barre.append(go.Bar(x=righe["Data"].to_numpy(), y=righe["Importo"].to_numpy(), name=tipo, marker_color=colore))
+    fig = go.Figure(barre)
+    fig.update_layout(title="Trend", barmode="relative", legend_title_text="Tipo", xaxis_title="Data", yaxis_title="Importo")
+    return fig
+
 # --- 3. APP ---
-df = carica_dati()
+# I dati restano in sessione: filtri e widget non rifanno il download dal foglio
+if "df" not in st.session_state:
+    st.session_state.df = prepara_dati(carica_dati())
+controlla_salvataggi()
+df = st.session_state.df
 
 st.sidebar.title("☁️ Comandi")
+if st.sidebar.button("🔄 Ricarica"):
+    # Prima gli inserimenti ancora in volo, altrimenti il nuovo download non li conterrebbe
+    controlla_salvataggi(attendi=True)
+    invalida_dati()
+    st.rerun()
 st.sidebar.subheader("➕ Aggiungi")
 
 with st.sidebar.form("form_inserimento", clear_on_submit=True):
     data_input = st.date_input("Data", datetime.date.today())
-    tipo_input = st.selectbox("Tipo", ["Uscita", "Entrata"])
+    tipo_input = st.selectbox("Tipo", TIPI)
     
-    if tipo_input == "Uscita":
-        cat_list = ["Cibo", "Casa", "Trasporti", "Salute", "Svago", "Shopping", "Bollette", "Altro"]
-    else:
-        cat_list = ["Stipendio", "Bonus", "Vendite", "Rimborsi", "Investimenti", "Altro"]
-        
+    cat_list = CAT_USCITA if tipo_input == "Uscita" else CAT_ENTRATA
     categoria_input = st.selectbox("Categoria", cat_list)
     importo_input = st.number_input("Importo (€)", min_value=0.0, format="%.2f")
     note_input = st.text_input("Note")
     
     if st.form_submit_button("Salva"):
-        nuovo_record = pd.DataFrame({
-            "ID": [genera_id()],
-            "Data": [pd.to_datetime(data_input)],
-            "Tipo": [tipo_input],
-            "Categoria": [categoria_input],
-            "Importo": [importo_input],
-            "Note": [note_input]
-        })
-        
-        df = pd.concat([df, nuovo_record], ignore_index=True) if not df.empty else nuovo_record
+        nuovo_record = [
+            genera_id(),
+            data_input.strftime('%Y-%m-%d'),
+            tipo_input,
+            categoria_input,
+            importo_input,
+            note_input
+        ]
         
-        with st.spinner("Salvataggio..."):
-            if salva_dati_su_cloud(df):
-                st.success("Salvato!")
-                st.rerun()
+        # La scrittura parte in background: la riga compare subito, l'esito arriva al prossimo rerun.
+        # Al worker va una tupla: nessuno stato condiviso con il thread dello script
+        futuro = _pool().submit(append_record, connetti_google_sheet(), tuple(nuovo_record))
+        st.session_state.setdefault("save_futures", []).append((nuovo_record[0], futuro))
+        st.session_state.df = aggiungi_riga(df, dict(zip(COLONNE, nuovo_record), Data=pd.Timestamp(data_input)))
+        st.rerun()
 
-st.sidebar.markdown("---")
-anno_corrente = datetime.date.today().year
-if not df.empty and "Data" in df.columns:
-    try:
-        anni_dal_db = df["Data"].dt.year.dropna().astype(int).unique().tolist()
-    except: anni_dal_db = []
-else: anni_dal_db = []
+# Frammento: cambiare anno o interagire con grafico ed editor rilancia solo la dashboard,
+# senza ripassare dal form di inserimento e dalla preparazione dei dati
+@st.fragment
+def render_dashboard(df):
+    anno_corrente = datetime.date.today().year
+    if not df.empty and "Data" in df.columns:
+        try:
+            anni_dal_db = df["Anno"].unique().tolist()
+        except: anni_dal_db = []
+    else: anni_dal_db = []
 
-anno_selezionato = st.sidebar.selectbox("Anno", sorted(list(set(anni_dal_db + [anno_corrente])), reverse=True))
+    titolo = st.empty()
+    anno_selezionato = st.selectbox("Anno", sorted(list(set(anni_dal_db + [anno_corrente])), reverse=True))
 
-if not df.empty:
-    df_filtrato = df[df["Data"].dt.year == anno_selezionato]
-else:
-    df_filtrato = pd.DataFrame(columns=df.columns)
+    if not df.empty:
+        df_filtrato = df.loc[str(anno_selezionato):str(anno_selezionato)].reset_index(drop=True)
+    else:
+        df_filtrato = pd.DataFrame(columns=df.columns)
 
-st.title(f"📊 Dashboard {anno_selezionato}")
+    titolo.title(f"📊 Dashboard {anno_selezionato}")
 
-if not df_filtrato.empty:
-    entrate = df_filtrato[df_filtrato["Tipo"] == "Entrata"]["Importo"].sum()
-    uscite = df_filtrato[df_filtrato["Tipo"] == "Uscita"]["Importo"].sum()
+    if not df_filtrato.empty:
+        totali = df_filtrato.groupby("Tipo", observed=True)["Importo"].sum()
+        entrate = totali.get("Entrata", 0.0)
+        uscite = totali.get("Uscita", 0.0)
     
-    c1, c2, c3 = st.columns(3)
-    c1.metric("Entrate", f"€ {entrate:,.2f}")
-    c2.metric("Uscite", f"€ {uscite:,.2f}")
-    c3.metric("Saldo", f"€ {entrate-uscite:,.2f}")
+        c1, c2, c3 = st.columns(3)
+        c1.metric("Entrate", f"€ {entrate:,.2f}")
+        c2.metric("Uscite", f"€ {uscite:,.2f}")
+        c3.metric("Saldo", f"€ {entrate-uscite:,.2f}")
     
-    st.plotly_chart(px.bar(df_filtrato, x="Data", y="Importo", color="Tipo", title="Trend", color_discrete_map={"Entrata": "#00CC96", "Uscita": "#EF553B"}), use_container_width=True)
+        st.plotly_chart(crea_grafico_trend(df_filtrato[["Data", "Importo", "Tipo"]]), use_container_width=True)
 
-    st.subheader("📝 Modifica")
-    df_modificato = st.data_editor(df_filtrato, num_rows="dynamic", hide_index=True, key="editor")
+        st.subheader("📝 Modifica")
+        df_modificato = st.data_editor(df_filtrato, num_rows="dynamic", hide_index=True, column_config={"Anno": None}, key="editor")
 
-    if st.button("💾 Salva Modifiche"):
-        df_db = carica_dati()
-        ids_visualizzati = df_filtrato["ID"].tolist()
-        df_db = df_db[~df_db["ID"].isin(ids_visualizzati)]
-        
-        for i, row in df_modificato.iterrows():
-            if pd.isna(row["ID"]) or row["ID"] == "": df_modificato.at[i, "ID"] = genera_id()
-            
-        df_finale = pd.concat([df_db, df_modificato], ignore_index=True)
-        if salva_dati_su_cloud(df_finale):
-            st.success("Fatto!")
-            st.rerun()
-else:
-    st.info("Nessun dato.")
+        if st.button("💾 Salva Modifiche"):
+            mancanti = df_modificato["ID"].isna() | (df_modificato["ID"] == "")
+            df_modificato.loc[mancanti, "ID"] = [genera_id() for _ in range(int(mancanti.sum()))]
+            # Gli inserimenti ancora in volo devono essere sul foglio prima del diff
+            controlla_salvataggi(attendi=True)
+
+            if salva_modifiche(df_filtrato, df_modificato):
+                st.success("Fatto!")
+                st.rerun()
+    else:
+        st.info("Nessun dato.")
+
+render_dashboard(df)